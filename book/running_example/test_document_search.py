@@ -0,0 +1,1170 @@
+"""Tests for the private document search running example
+
+Run with: python -m pytest book/running_example
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import math
+import random
+import threading
+from itertools import combinations
+
+import pytest
+
+import document_search as ds
+from document_search import (AndQuery, BlockedBloomFilter, BloomFilter,
+                             ConcurrentSearch, CountMinSketch, Document,
+                             DocumentSignatures, FrequencyHidingIndex, HashEncoder,
+                             HashSetBuilder, InvertedIndex, KeywordExtractor,
+                             LazyEncodings, NotQuery, PairMiner, PairQuery, PostingList,
+                             PrivateDocumentSearch, QueryCache, QueryPlanner,
+                             ScalableBloomFilter, SearchServer, ShardedIndex, TermQuery,
+                             TupleAwareIndex, iter_jsonl, load_index, parse_query,
+                             search_remote)
+
+WORDS = ["covid", "vaccine", "security", "breach", "password", "leak", "data",
+         "privacy", "encryption", "backdoor", "alpha", "bravo", "charlie", "delta"]
+
+QUERIES = ["covid", "vaccine", "covid AND vaccine", "security OR breach",
+           "data AND NOT privacy", "alpha", "charlie AND delta", "unindexed"]
+
+
+def make_docs(n, seed=1, prefix="d"):
+    rng = random.Random(seed)
+    return [(f"{prefix}{i}", " ".join(rng.sample(WORDS, rng.randint(1, 4))))
+            for i in range(n)]
+
+
+def truth(docs, term):
+    return {doc_id for doc_id, content in docs if term in content.split()}
+
+
+def filter_bytes(bloom):
+    """Bit content of a filter, comparable across indexes"""
+    if isinstance(bloom, ScalableBloomFilter):
+        return [bytes(s.bits) for s in bloom.slices]
+    return bytes(bloom.bits)
+
+
+@pytest.fixture(params=["numpy", "pure"])
+def backend(request, monkeypatch):
+    """Run a test with NumPy and with the pure-Python fallback"""
+    if request.param == "pure":
+        monkeypatch.setattr(ds, "np", None)
+    elif ds.np is None:
+        pytest.skip("NumPy not installed")
+    return request.param
+
+
+# ----------------------------------------------------------------------------
+# Bloom filters
+# ----------------------------------------------------------------------------
+
+def test_bits_are_packed(backend):
+    bloom = BloomFilter(10000, 0.01)
+    assert isinstance(bloom.bits, bytearray)
+    assert len(bloom.bits) == (bloom.size + 7) // 8
+    items = [f"doc{i}" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert bloom.count == len(items)
+    assert all(bloom.contains(item) for item in items)
+    assert (sum(bloom._get_bit(pos) for pos in range(bloom.size))
+            == int.from_bytes(bloom.bits, "little").bit_count())
+
+
+def test_union_and_intersect_are_bitwise(backend):
+    a, b = BloomFilter(1000, 0.01), BloomFilter(1000, 0.01)
+    for i in range(300):
+        a.add(f"a{i}")
+        b.add(f"b{i}")
+    a.add("shared")
+    b.add("shared")
+    bits_a = bytes(a.bits)
+
+    union = a.union(b)
+    assert bytes(union.bits) == bytes(x | y for x, y in zip(a.bits, b.bits))
+    assert union.contains("a1") and union.contains("b1")
+    intersection = a.intersect(b)
+    assert bytes(intersection.bits) == bytes(x & y for x, y in zip(a.bits, b.bits))
+    assert intersection.contains("shared")
+    assert bytes(a.bits) == bits_a  # operands are left alone
+
+    # Different geometries share no bit layout and combine lazily
+    mixed = a.union(BloomFilter(10, 0.01))
+    assert mixed.contains("a1") and not mixed.contains("b1")
+
+
+def test_probes_derive_from_one_digest():
+    bloom = BloomFilter(1000, 0.01)
+    digest = hashlib.sha256(b"doc42").digest()
+    h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:16], "big")
+    assert bloom._positions("doc42") == [((h1 + i * h2) % 2**64) % bloom.size
+                                         for i in range(bloom.num_hashes)]
+
+
+@pytest.mark.parametrize("family", sorted(ds.HASH_FAMILIES))
+def test_hash_families_meet_fp_rate(family):
+    bloom = BloomFilter(5000, 0.01, family)
+    for i in range(5000):
+        bloom.add(f"in{i}")
+    assert all(bloom.contains(f"in{i}") for i in range(5000))
+    false_positives = sum(bloom.contains(f"out{i}") for i in range(20000))
+    assert false_positives / 20000 < 0.02
+
+
+def test_unknown_hash_family():
+    with pytest.raises(ValueError, match="hash family"):
+        BloomFilter(100, 0.01, "md5")
+    with pytest.raises(ValueError, match="hash family"):
+        PrivateDocumentSearch(hash_family="md5")
+
+
+def test_index_hash_family(tmp_path):
+    docs = make_docs(200)
+    system = PrivateDocumentSearch(hash_family="blake2b")
+    system.add_documents(docs[:100])
+    system.index.hybrid = True  # posting lists for the keywords added next
+    system.add_documents(docs[100:])
+    assert system.signatures.hash_family == "blake2b"
+    filters = [f for table in system.index._filter_maps().values() for f in table.values()]
+    assert any(isinstance(f, PostingList) for f in filters)
+    assert {f.hash_family for f in filters} == {"blake2b"}
+    for term in WORDS:
+        assert set(system.search(term)) >= truth(docs, term)
+
+    path = str(tmp_path / "blake2b.btix")
+    system.save(path)
+    loaded = PrivateDocumentSearch.load(path)
+    assert loaded.index.hash_family == "blake2b"
+    assert loaded.search_many(QUERIES) == system.search_many(QUERIES)
+    loaded.add_document("extra", "covid")
+    assert loaded.index.search("covid").hash_family == "blake2b"
+
+
+@pytest.mark.parametrize("make", [
+    lambda: BloomFilter(2000, 0.01),
+    lambda: BlockedBloomFilter(2000, 0.01),
+    lambda: ScalableBloomFilter(100, 0.01),
+], ids=["plain", "blocked", "scalable"])
+def test_batch_api_matches_loop(backend, make):
+    items = [f"doc{i}" for i in range(1500)]
+    looped, batched = make(), make()
+    for item in items:
+        looped.add(item)
+    batched.add_many(items)
+    batched.add_many([])
+    assert filter_bytes(batched) == filter_bytes(looped)
+    assert batched.count == looped.count == len(items)
+
+    probes = items[::7] + [f"other{i}" for i in range(3000)]
+    mask = batched.contains_many(probes)
+    assert len(mask) == len(probes)
+    assert [bool(hit) for hit in mask] == [looped.contains(p) for p in probes]
+    assert len(batched.contains_many([])) == 0
+
+
+def test_nary_kernels_match_pairwise(backend):
+    filters = [BloomFilter(500, 0.01) for _ in range(4)]
+    for i, bloom in enumerate(filters):
+        bloom.add_many([f"doc{j}" for j in range(i * 50, i * 50 + 300)])
+    union = BloomFilter.union_all(filters)
+    assert bytes(union.bits) == bytes(
+        filters[0].union(filters[1]).union(filters[2]).union(filters[3]).bits)
+    assert union.count == sum(b.count for b in filters)
+    intersection = BloomFilter.intersect_all(filters)
+    assert bytes(intersection.bits) == bytes(
+        filters[0].intersect(filters[1]).intersect(filters[2]).intersect(filters[3]).bits)
+    assert intersection.contains("doc200") and intersection.count == 300
+
+    # Accumulate into a preallocated output, or in place into an operand
+    out = filters[0]._blank()
+    assert BloomFilter.intersect_all(filters, out=out) is out
+    assert bytes(out.bits) == bytes(intersection.bits)
+    first = filters[0].copy()
+    assert first.union_update(filters[1]) is first
+    assert bytes(first.bits) == bytes(filters[0].union(filters[1]).bits)
+    with pytest.raises(ValueError):
+        BloomFilter.union_all([])
+    with pytest.raises(ValueError, match="same size"):
+        BloomFilter.union_all([filters[0], BloomFilter(10, 0.01)], out=out)
+
+
+def test_scalable_filter_grows_within_fp_bound(backend):
+    bloom = ScalableBloomFilter(initial_capacity=100, fp_rate=0.01)
+    assert bloom.slices == [] and bloom.size == 0
+    items = [f"in{i}" for i in range(5000)]
+    bloom.add_many(items[:2500])
+    for item in items[2500:]:
+        bloom.add(item)
+    assert len(bloom.slices) > 3
+    assert all(s.count <= c for s, c in zip(bloom.slices, bloom._capacities))
+    assert [s.size for s in bloom.slices[1:]] == [2 * s.size for s in bloom.slices[:-1]]
+    assert all(bloom.contains(item) for item in items)
+    # Each slice's expected rate at its fill; together within fp_rate
+    expected = sum((1 - math.exp(-s.num_hashes * s.count / s.size)) ** s.num_hashes
+                   for s in bloom.slices)
+    assert expected <= 0.01
+    false_positives = sum(bloom.contains(f"out{i}") for i in range(20000))
+    assert false_positives / 20000 < 1.5 * 0.01
+
+
+def test_index_filters_are_scalable_by_default():
+    index = InvertedIndex()
+    for i in range(300):
+        index.index_document(Document(f"d{i}", None, {"hot"} | ({"rare"} if i < 2 else set())))
+    hot, rare = index.search("hot"), index.search("rare")
+    assert isinstance(hot, ScalableBloomFilter) and len(hot.slices) > 1
+    assert rare.size < hot.size < BloomFilter(index.docs_per_keyword, 0.01).size
+    assert isinstance(InvertedIndex(scalable=False)._new_filter("x"), BloomFilter)
+
+
+def test_probe_matrix_cache_is_bounded(monkeypatch):
+    signatures = DocumentSignatures()
+    for i in range(2000):
+        signatures.add(f"d{i}")
+    filters = [BloomFilter(100 * (i + 1), 0.01) for i in range(6)]
+    one = signatures.positions(filters[0])
+    monkeypatch.setattr(ds, "_POSITIONS_BUDGET", 3 * one.nbytes if ds.np is not None
+                        else 3 * 8 * filters[0].num_hashes * len(one))
+    for bloom in filters:
+        signatures.match(bloom)
+    assert 1 <= len(signatures._positions) <= 3
+    newest = (filters[-1].size, filters[-1].num_hashes, 0)
+    assert list(signatures._positions)[-1] == newest
+
+
+
+def test_blocked_probes_share_one_block(backend):
+    bloom = BlockedBloomFilter(1000, 0.01)
+    assert bloom.size % 512 == 0
+    digests = [ds._split_digest(hashlib.sha256(f"x{i}".encode()).digest())
+               for i in range(200)]
+    for h1, h2 in digests:
+        positions = bloom._positions_for(h1, h2)
+        assert len(set(positions)) == bloom.num_hashes
+        assert len({p // 512 for p in positions}) == 1
+    if backend == "numpy":
+        matrix = bloom._probe_matrix(ds.np.array([h1 for h1, _ in digests], dtype="u8"),
+                                     ds.np.array([h2 for _, h2 in digests], dtype="u8"))
+        assert matrix.tolist() == [bloom._positions_for(*d) for d in digests]
+
+
+def test_blocked_filter_fp_rate(backend):
+    bloom = BlockedBloomFilter(5000, 0.01)
+    bloom.add_many(f"in{i}" for i in range(5000))
+    assert all(bloom.contains_many([f"in{i}" for i in range(5000)]))
+    rate = sum(bloom.contains_many([f"out{i}" for i in range(20000)])) / 20000
+    assert rate < 0.02  # about 1.3x the classic layout's 1%
+    other = BlockedBloomFilter(5000, 0.01)
+    other.add("extra")
+    assert bloom.union(other).contains("extra")
+    assert not bloom.intersect(other).contains("in1")
+
+
+
+def test_hash_set_builder_serial_matches_parallel(backend):
+    items = [[f"s{j}-{i}" for i in range(n)] for j, n in enumerate([120, 40, 0, 1])]
+    serial = HashSetBuilder(bucket_size=1.5)
+    sets = [serial.build(column) for column in items]
+    columns = [ds._digest_columns(column, "sha256") for column in items]
+    assert [s.to_bytes() for s in serial.build_many(columns)] == [
+        s.to_bytes() for s in sets]
+    parallel = HashSetBuilder(bucket_size=1.5, workers=2)
+    assert [s.to_bytes() for s in parallel.build_many(columns)] == [
+        s.to_bytes() for s in sets]
+    for column, hash_set in zip(items, sets):
+        assert all(hash_set.contains(item) for item in column)
+    rate = sum(map(sets[0].contains, (f"out{i}" for i in range(5000)))) / 5000
+    assert rate < 0.02
+
+
+# ----------------------------------------------------------------------------
+# Keyword encoding
+# ----------------------------------------------------------------------------
+
+def test_encoder_cache_is_bounded_lru():
+    salt = b"s" * 32
+    encoder = HashEncoder(salt, cache_size=2)
+    expected = {v: hashlib.sha256(v.encode() + salt).hexdigest()
+                for v in ["covid", "vaccine", "data"]}
+    assert encoder.encode("covid") == expected["covid"]
+    assert encoder.encode("vaccine") == expected["vaccine"]
+    assert encoder.encode("covid") == expected["covid"]  # hit; now most recent
+    assert encoder.encode("data") == expected["data"]  # evicts vaccine
+    assert encoder.cache_info() == {"hits": 1, "misses": 3, "size": 2, "capacity": 2}
+    assert encoder.encode("vaccine") == expected["vaccine"]
+    assert encoder.cache_info()["misses"] == 4
+    assert encoder.encode("data") == expected["data"]
+    assert encoder.cache_info()["hits"] == 2
+
+    uncached = HashEncoder(salt, cache_size=0)
+    assert uncached.encode("covid") == expected["covid"]
+    assert uncached.cache_info()["size"] == 0
+    encoder.clear_cache()
+    assert encoder.cache_info() == {"hits": 0, "misses": 0, "size": 0, "capacity": 2}
+
+
+def test_encode_multiple_is_unchanged():
+    encoder = HashEncoder(b"s" * 32)
+    assert encoder.encode_multiple("covid", 3) == [
+        hashlib.sha256(f"covid:{i}".encode() + b"s" * 32).hexdigest() for i in range(3)]
+
+
+
+def test_lazy_encodings_match_encode_multiple():
+    encoder = HashEncoder(b"s" * 32)
+    encodings = LazyEncodings(encoder, "covid", 50)
+    assert list(encodings) == encoder.encode_multiple("covid", 50)
+    assert encodings[-1] == encodings[49] and encodings[10:13] == list(encodings)[10:13]
+    with pytest.raises(IndexError):
+        encodings[50]
+
+
+def test_update_frequencies_touches_only_changed_terms():
+    index = FrequencyHidingIndex({"covid": 0.5, "vaccine": 0.01, "data": 0.1})
+    kept = index.encoding_map["data"]
+    assert index.update_frequencies({"covid": 0.25, "data": 0.1, "leak": 0.2}) == {
+        "covid", "leak"}
+    assert index.encoding_map["data"] is kept
+    assert [len(index.encoding_map[t]) for t in ["covid", "vaccine", "leak"]] == [4, 100, 5]
+    assert index.update_frequencies({"data": 0.1}, replace=True) == {
+        "covid", "vaccine", "leak"}
+    assert set(index.encoding_map) == set(index.term_frequencies) == {"data"}
+    assert index.encoding_map["data"] is kept
+
+
+# ----------------------------------------------------------------------------
+# Result materialization
+# ----------------------------------------------------------------------------
+
+def test_signatures_match_contains_scan(backend):
+    doc_ids = [f"doc{i}" for i in range(3000)]
+    signatures = DocumentSignatures()
+    for doc_id in doc_ids:
+        signatures.add(doc_id)
+    filters = [BloomFilter(500, 0.05), BlockedBloomFilter(500, 0.05),
+               ScalableBloomFilter(50, 0.05), PostingList(), BloomFilter(500, 0.05)]
+    for i, bloom in enumerate(filters[:4]):
+        bloom.add_many(doc_ids[i::9])
+    filters[4].add_many(doc_ids[::2] + doc_ids[1::2])  # nearly saturated
+
+    expected = [[d for d in doc_ids if bloom.contains(d)] for bloom in filters]
+    assert [signatures.match(bloom) for bloom in filters] == expected
+    masks = signatures.mask_many(filters + [None])
+    assert [signatures.ids(m) for m in masks] == expected + [[]]
+    # Probe matrices are cached per geometry and extended for new rows
+    signatures.add("late")
+    filters[0].add("late")
+    assert signatures.match(filters[0])[-1] == "late"
+
+
+def test_search_matches_contains_scan():
+    docs = make_docs(500)
+    system = PrivateDocumentSearch()
+    system.add_documents(docs)
+    for term in ["alpha", "bravo", "charlie"]:
+        bloom = system.index.search(term)
+        assert system.search(term) == [d for d, _ in docs if bloom.contains(d)]
+    result = system.index.search("alpha").intersect(system.index.search("bravo"))
+    assert system.search("alpha AND bravo") == [d for d, _ in docs if result.contains(d)]
+
+
+# ----------------------------------------------------------------------------
+# Queries
+# ----------------------------------------------------------------------------
+
+def evaluate(node, member):
+    """Reference evaluation of a query AST, given leaf membership"""
+    if isinstance(node, TermQuery):
+        return member(node.term)
+    if isinstance(node, NotQuery):
+        return not evaluate(node.operand, member)
+    test = all if isinstance(node, AndQuery) else any
+    return test(evaluate(op, member) for op in node.operands)
+
+
+def test_parse_query():
+    assert parse_query("a OR b AND NOT c").canonical() == "(OR (AND (NOT c) b) a)"
+    assert parse_query("(a OR b) AND c").canonical() == "(AND (OR a b) c)"
+    node = parse_query("NOT NOT (A AND (b AND c)) AND a")
+    assert QueryPlanner.normalize(node).canonical() == "(AND a b c)"
+    assert isinstance(parse_query("Covid"), TermQuery)
+    assert parse_query("Covid").term == "covid"
+    for bad in ["", "covid vaccine", "(covid", "covid)", "AND covid", "covid OR"]:
+        with pytest.raises(ValueError):
+            parse_query(bad)
+
+
+def test_planner_matches_reference_evaluation(backend):
+    docs = make_docs(400)
+    index = InvertedIndex()
+    signatures = DocumentSignatures()
+    for doc_id, content in docs:
+        index.index_document(Document(doc_id, None, set(content.split())))
+        signatures.add(doc_id)
+    queries = ["alpha AND bravo", "alpha AND (bravo OR charlie) AND NOT delta",
+               "NOT (alpha OR bravo)", "(covid AND NOT vaccine) OR (data AND privacy)",
+               "alpha AND unindexed", "unindexed OR charlie", "NOT unindexed"]
+
+    def accepts(doc_id):
+        # Each leaf answers as its filter does; NOT inherits its false positives
+        return lambda term: (index.search(term) is not None
+                             and index.search(term).contains(doc_id))
+
+    planner = QueryPlanner(index)
+    for query in queries:
+        node = parse_query(query)
+        expected = [d for d, _ in docs if evaluate(node, accepts(d))]
+        assert planner.execute(node, signatures) == expected
+        assert planner.execute_many([node], signatures) == [expected]
+        if "NOT" not in query:
+            exact = {d for d, content in docs
+                     if evaluate(node, lambda term: term in content.split())}
+            assert set(expected) >= exact
+
+
+def test_planner_orders_and_short_circuits(monkeypatch):
+    index = InvertedIndex()
+    for i in range(50):
+        index.index_document(Document(f"d{i}", None, {"common", "rare"} if i < 3
+                                      else {"common"}))
+    planner = QueryPlanner(index)
+    plan = planner.optimize(parse_query("common AND rare"))
+    assert [op.term for op in plan.operands] == ["rare", "common"]
+
+    calls = []
+    monkeypatch.setattr(BloomFilter, "intersect_all",
+                        staticmethod(lambda filters, out=None: calls.append(filters)))
+    signatures = DocumentSignatures()
+    assert planner.execute(parse_query("common AND rare AND unindexed"), signatures) == []
+    assert not calls  # the empty conjunct ends evaluation before any intersection
+
+
+def test_planner_uses_pair_filters():
+    docs = make_docs(300)
+    index = TupleAwareIndex({("alpha", "bravo")})
+    signatures = DocumentSignatures()
+    for doc_id, content in docs:
+        index.index_document(Document(doc_id, None, set(content.split())))
+        signatures.add(doc_id)
+    planner = QueryPlanner(index)
+    plan = planner.optimize(parse_query("charlie AND bravo AND alpha"))
+    assert any(isinstance(op, PairQuery) for op in plan.operands)
+    exact = truth(docs, "alpha") & truth(docs, "bravo") & truth(docs, "charlie")
+    assert set(planner.execute(parse_query("charlie AND bravo AND alpha"),
+                               signatures)) >= exact
+
+    # A pair declared common after indexing has no filter yet: AND its terms
+    index.common_pairs = index.common_pairs | {("charlie", "delta")}
+    plan = planner.optimize(parse_query("charlie AND delta"))
+    assert isinstance(plan, AndQuery) and not any(isinstance(op, PairQuery)
+                                                  for op in plan.operands)
+    assert set(planner.execute(parse_query("charlie AND delta"), signatures)) >= (
+        truth(docs, "charlie") & truth(docs, "delta"))
+
+
+def test_search_rejects_malformed_queries_quietly():
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(50))
+    assert system.search("") == []
+    assert system.search("covid vaccine") == []
+    assert system.search_many(["covid AND", "covid"])[0] == []
+
+
+def test_query_cache_eviction():
+    now = [0.0]
+    cache = QueryCache(capacity=2, ttl=10, clock=lambda: now[0])
+    key = QueryCache.key(parse_query("b AND (a AND b)"))
+    assert key == QueryCache.key(parse_query("a AND b"))
+    cache.put(key, 1, ["d1"])
+    assert cache.get(key, 1) == ["d1"]
+    assert cache.get(key, 2) is None  # newer generation: stale, and dropped
+    assert cache.get(key, 1) is None
+
+    cache.put("x", 1, ["d1"])
+    cache.put("y", 1, ["d2"])
+    cache.get("x", 1)
+    cache.put("z", 1, ["d3"])  # evicts y, the least recently used
+    assert cache.get("y", 1) is None and cache.get("x", 1) == ["d1"]
+    now[0] = 10.5
+    assert cache.get("x", 1) is None  # expired
+    assert cache.stats()["evictions"] == 1
+
+    small = QueryCache(max_bytes=300)
+    for i in range(10):
+        small.put(f"k{i}", 1, [f"d{i}"])
+    assert 0 < small.stats()["entries"] < 10
+    assert small.bytes_used <= 300
+
+
+def test_search_results_are_cached_per_generation():
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(100))
+    first = system.search("covid AND vaccine")
+    assert system.search("vaccine AND covid") == first
+    assert system.cache.stats()["hits"] == 1
+    system.add_document("new", "covid vaccine")
+    assert system.search("covid AND vaccine") == first + ["new"]
+    # Term queries are cached by term, whichever encoding the lookup picked
+    system.search("covid")
+    hits = system.cache.stats()["hits"]
+    system.search("covid")
+    assert system.cache.stats()["hits"] == hits + 1
+
+
+# ----------------------------------------------------------------------------
+# Indexing
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_bulk_index_matches_serial(hybrid):
+    docs = [Document(doc_id, None, set(content.split()))
+            for doc_id, content in make_docs(400)]
+    serial = InvertedIndex(hybrid=hybrid)
+    parallel = serial._empty_copy()  # same salt, so the same slots
+    for doc in docs:
+        serial.index_document(doc)
+    parallel.bulk_index(docs, workers=2)
+    assert set(parallel.keyword_to_docs) == set(serial.keyword_to_docs)
+    for key, bloom in serial.keyword_to_docs.items():
+        other = parallel.keyword_to_docs[key]
+        assert type(other) is type(bloom)
+        if isinstance(bloom, PostingList):
+            assert list(other.h1) == list(bloom.h1)
+        else:
+            assert filter_bytes(other) == filter_bytes(bloom)
+
+
+def test_ingest_matches_add_documents():
+    docs = make_docs(500)
+    added = PrivateDocumentSearch()
+    added.add_documents(docs)
+    streamed = PrivateDocumentSearch()
+    streamed.index._restore_state(added.index._header_state())  # same salt
+    assert streamed.ingest(iter(docs), batch_size=64, workers=2) == len(docs)
+    assert list(streamed.signatures.doc_ids) == [doc_id for doc_id, _ in docs]
+    for name, table in added.index._filter_maps().items():
+        other = getattr(streamed.index, name)
+        assert set(other) == set(table)
+        for key, bloom in table.items():
+            assert filter_bytes(other[key]) == filter_bytes(bloom)
+
+
+def test_ingest_jsonl_keeps_only_ids(tmp_path):
+    docs = make_docs(300)
+    path = tmp_path / "docs.jsonl"
+    path.write_text("".join(json.dumps({"id": d, "content": c}) + "\n" for d, c in docs))
+    system = PrivateDocumentSearch()
+    assert system.ingest(iter_jsonl(str(path)), batch_size=50) == len(docs)
+    assert system.documents == []
+    assert len(system.signatures) == len(docs)
+    for term in WORDS:
+        assert set(system.search(term)) >= truth(docs, term)
+
+
+def test_count_min_sketch_never_undercounts():
+    sketch = CountMinSketch(width=64, depth=4)
+    counts = {f"k{i}": i % 7 + 1 for i in range(200)}
+    for item, n in counts.items():
+        for _ in range(n):
+            sketch.add(item)
+    assert all(sketch.estimate(item) >= n for item, n in counts.items())
+    assert sketch.total == sum(counts.values())
+
+
+@pytest.mark.parametrize("sizing", ["sketch", "frequencies"])
+def test_sized_filters_stay_within_fp_rate(sizing):
+    system = PrivateDocumentSearch()
+    report = system.add_documents(make_docs(200), sizing=sizing)
+    filters = {id(f): f for table in system.index._filter_maps().values()
+               for f in table.values()}  # encoding slots alias their filter
+    assert report["bits"] == sum(f.size for f in filters.values())
+    assert report["bits_saved"] == report["uniform_bits"] - report["bits"] > 0
+    assert system.index.expected_counts is None  # estimates cover one batch
+    with pytest.raises(ValueError):
+        system.add_documents([], sizing="guess")
+
+    # A keyword sized for a few documents keeps growing with later batches
+    bloom = system.index.search("alpha")
+    first_slice = bloom.slices[0].size
+    system.add_documents([(f"more{i}", "alpha") for i in range(2000)])
+    bloom = system.index.search("alpha")
+    assert bloom.slices[0].size == first_slice and len(bloom.slices) > 1
+    false_positives = sum(bloom.contains(f"absent{i}") for i in range(5000))
+    assert false_positives / 5000 < 0.02
+
+
+
+def test_pair_indexing_matches_all_combinations():
+    docs = make_docs(300)
+    pairs = {("alpha", "bravo"), ("covid", "vaccine"), ("data", "privacy"), ("zulu", "alpha")}
+    serial = TupleAwareIndex(pairs)
+    for doc_id, content in docs:
+        keywords = set(content.split())
+        assert set(serial._doc_pairs(keywords)) == {
+            p for p in combinations(sorted(keywords), 2) if p in serial.common_pairs}
+        serial.index_document(Document(doc_id, None, keywords))
+    batched = serial._empty_copy()
+    batched.index_documents(Document(d, None, set(c.split())) for d, c in docs)
+    assert set(batched.pair_to_docs) == set(serial.pair_to_docs)
+    for key, bloom in serial.pair_to_docs.items():
+        assert filter_bytes(batched.pair_to_docs[key]) == filter_bytes(bloom)
+    both = truth(docs, "alpha") & truth(docs, "bravo")
+    assert {d for d, _ in docs if serial.search_pair("bravo", "alpha").contains(d)} >= both
+    assert serial.search_pair("alpha", "charlie") is None
+
+
+
+def test_pair_miner_tracks_frequent_pairs_in_bounded_memory():
+    rng = random.Random(3)
+    miner = PairMiner(capacity=20)
+    for _ in range(500):
+        noise = rng.sample(WORDS[2:], 3)
+        if rng.random() < 0.5:
+            noise += ["covid", "vaccine"]
+        miner.add_document(noise)
+    assert len(miner.counts) <= 20
+    (pair, count), = miner.top(1)
+    assert pair == ("covid", "vaccine") and count >= 200
+    miner.add_query(parse_query("(alpha AND bravo) OR delta"))
+    assert ("alpha", "bravo") in miner.counts
+    assert len(miner.counts) <= 20
+
+
+def test_refresh_common_pairs_backfills_without_rescan():
+    docs = make_docs(400)
+    system = PrivateDocumentSearch()
+    system.pair_miner = PairMiner()
+    system.add_documents(docs)
+    old = set(system.index.common_pairs)
+    top = {pair for pair, _ in system.pair_miner.top(5, min_count=2)}
+    before = {pair: set(system.search(" AND ".join(pair))) for pair in top}
+    added, removed = system.refresh_common_pairs(top_n=5)
+    assert (added, removed) == (top - old, old - top)
+    assert system.common_pairs == top
+    for kw1, kw2 in added:
+        pair = system.index.search_pair(kw1, kw2)
+        assert pair is not None
+        matched = {doc_id for doc_id, _ in docs if pair.contains(doc_id)}
+        assert matched >= truth(docs, kw1) & truth(docs, kw2)
+    for (kw1, kw2), results in before.items():
+        both = truth(docs, kw1) & truth(docs, kw2)
+        assert results >= set(system.search(f"{kw1} AND {kw2}")) >= both
+    system.pair_miner = PairMiner()
+    assert system.refresh_common_pairs() == (set(), top)
+    assert not system.index.pair_to_docs
+
+
+
+
+def baseline_keywords(content):
+    """Keyword extraction as Document did before KeywordExtractor"""
+    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for'}
+    return {w for w in content.lower().split() if w not in stop_words and len(w) > 2}
+
+
+def random_texts(n, seed=5):
+    rng = random.Random(seed)
+    vocab = WORDS + ["The", "AND", "to", "ok", "Covid,", "e-mail", "x", "data."]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(0, 12)))
+            for _ in range(n)]
+
+
+def test_keyword_extractor_matches_baseline():
+    extractor = KeywordExtractor()
+    texts = random_texts(300)
+    keywords = [extractor(text) for text in texts]
+    assert keywords == [baseline_keywords(text) for text in texts]
+    assert [Document("d", text).keywords for text in texts] == keywords
+    interned = {id(k) for kws in keywords for k in kws if k == "covid"}
+    assert len(interned) == 1
+    assert KeywordExtractor(r"[a-z]+")("Covid, e-mail") == {"covid", "mail"}
+
+
+def test_extract_many_in_parallel():
+    extractor = KeywordExtractor()
+    texts = random_texts(200)
+    parallel = extractor.extract_many(texts, workers=2)
+    assert parallel == extractor.extract_many(texts)
+    assert len({id(k) for kws in parallel for k in kws if k == "covid"}) == 1
+    docs = extractor.extract_documents(zip(map(str, range(200)), texts), workers=2,
+                                       keep_content=False)
+    assert [doc.keywords for doc in docs] == parallel
+    assert all(doc.content is None for doc in docs)
+
+
+
+def test_posting_lists_are_exact_until_promoted(backend):
+    index = InvertedIndex(hybrid=True)
+    direct = index._empty_copy()
+    direct.hybrid = False
+    for i in range(300):
+        keywords = {"common"} | ({"rare"} if i % 100 == 0 else set())
+        index.index_document(Document(f"d{i}", None, keywords))
+        direct.index_document(Document(f"d{i}", None, keywords))
+    rare = index.search("rare")
+    assert isinstance(rare, PostingList) and len(rare) == 3
+    assert [d for d in map("d{}".format, range(300)) if rare.contains(d)] == [
+        "d0", "d100", "d200"]
+    common = index.search("common")
+    assert not isinstance(common, PostingList)
+    assert common.size < 128 * 300  # promoted once the filter was smaller
+    assert filter_bytes(common) == filter_bytes(direct.search("common"))
+
+    postings = PostingList()
+    postings.add_many(f"x{i}" for i in range(50))
+    bloom = postings.promote(ScalableBloomFilter(64, 0.01))
+    fresh = ScalableBloomFilter(64, 0.01)
+    fresh.add_many(f"x{i}" for i in range(50))
+    assert filter_bytes(bloom) == filter_bytes(fresh)
+
+
+# ----------------------------------------------------------------------------
+# Frequency hiding
+# ----------------------------------------------------------------------------
+
+class RecordingTable(dict):
+    """Filter table that records the keys looked up"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lookups = []
+
+    def get(self, key, default=None):
+        self.lookups.append(key)
+        return super().get(key, default)
+
+
+def assert_slots_alias(index, term):
+    primary = index.keyword_to_docs[index.encoder.encode(term)]
+    for slot in index.encoding_map[term]:
+        assert index.keyword_to_docs[slot] is primary
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_encoding_slots_alias_one_filter(hybrid):
+    docs = make_docs(300)
+    index = FrequencyHidingIndex({"alpha": 0.02, "covid": 0.5, "unindexed": 0.01})
+    index.hybrid = hybrid
+    for doc_id, content in docs:
+        index.index_document(Document(doc_id, None, set(content.split())))
+    for term in ["alpha", "covid"]:
+        assert_slots_alias(index, term)  # across promotion, with hybrid
+    assert index.encoder.encode_at("unindexed", 0) not in index.keyword_to_docs
+    filters = {id(f) for f in index.keyword_to_docs.values()}
+    assert len(filters) == len(set(WORDS))
+    assert len(index.keyword_to_docs) == len(filters) + 50 + 2
+
+    index.keyword_to_docs = RecordingTable(index.keyword_to_docs)
+    primary = index.keyword_to_docs[index.encoder.encode("alpha")]
+    assert all(index.search_uniform("alpha") is primary for _ in range(200))
+    lookups = set(index.keyword_to_docs.lookups)
+    assert len(lookups) > 40 and lookups <= set(index.encoding_map["alpha"])
+
+
+def test_bulk_index_aliases_merged_filters():
+    docs = [Document(d, None, set(c.split())) for d, c in make_docs(400)]
+    index = FrequencyHidingIndex({"alpha": 0.05})
+    index.bulk_index(docs, workers=2)
+    assert_slots_alias(index, "alpha")
+    assert len(index.keyword_to_docs) == len(set(WORDS)) + 20
+
+
+def test_update_frequencies_grows_and_drops_slots():
+    index = FrequencyHidingIndex({"alpha": 0.1})
+    for doc_id, content in make_docs(100):
+        index.index_document(Document(doc_id, None, set(content.split())))
+    table = index.keyword_to_docs
+    assert index.update_frequencies({"alpha": 0.05, "bravo": 0.25}) == {"alpha", "bravo"}
+    assert_slots_alias(index, "alpha")
+    assert_slots_alias(index, "bravo")
+    index.update_frequencies({"alpha": 0.5})
+    assert index.encoder.encode_at("alpha", 2) not in table
+    assert_slots_alias(index, "alpha")
+    index.update_frequencies({"alpha": 0.5}, replace=True)
+    assert index.encoder.encode_at("bravo", 0) not in table
+    assert len(table) == len(set(WORDS)) + 2
+
+
+def test_purge_re_points_slots():
+    system = PrivateDocumentSearch()
+    system.compaction_threshold = 1.0
+    docs = make_docs(200)
+    system.add_documents(docs)
+    for doc_id, _ in docs[:50]:
+        system.remove_document(doc_id)
+    assert system.compact() > 0
+    for term in system.term_frequencies:
+        if system.index.encoder.encode(term) in system.index.keyword_to_docs:
+            assert_slots_alias(system.index, term)
+    assert set(system.search("covid")) >= truth(docs[50:], "covid")
+
+
+def test_sharded_slots_resolve_on_the_owning_shard():
+    docs = make_docs(300)
+    with ShardedIndex({"alpha": 0.02, "covid": 0.5}, shards=3, processes=False) as index:
+        index.index_documents(Document(d, None, set(c.split())) for d, c in docs)
+        key = index.encoder.encode("alpha")
+        table = index._owner(key)._shard.tables["keyword_to_docs"]
+        for slot in index.encoding_map["alpha"]:
+            assert table[slot] is table[key]
+        expected = truth(docs, "alpha")
+        for _ in range(20):
+            bloom, = index.search_uniform_many(["alpha"])
+            assert {d for d, _ in docs if bloom.contains(d)} >= expected
+        assert sum(s["filters"] for s in index.shard_stats().values()) == len(set(WORDS))
+        assert len(list(index.keyword_to_docs)) == len(set(WORDS))
+
+        index.add_shard()
+        index.add_shard()
+        shard = index._owner(key)._shard
+        assert shard.aliases["keyword_to_docs"][key] == set(index.encoding_map["alpha"])
+        assert all(f is not None for f in index.search_uniform_many(["alpha"] * 20))
+        index.update_frequencies({"alpha": 0.5})
+        assert len(shard.aliases["keyword_to_docs"][key]) == 2
+        assert_slots_alias(index.collect(), "alpha")
+
+
+# ----------------------------------------------------------------------------
+# Persistence
+# ----------------------------------------------------------------------------
+
+def downgrade(path, version):
+    """Rewrite a saved file the way an older format version laid it out"""
+    with open(path, "rb") as f:
+        buf = f.read()
+    _, _, flags, header_len = ds._PREAMBLE.unpack_from(buf, 0)
+    header = json.loads(buf[ds._PREAMBLE.size:ds._PREAMBLE.size + header_len])
+    dir_offset = ds._PREAMBLE.size + header_len
+    entries = sum(t["entries"] for t in header["tables"].values())
+    directory = bytearray(buf[dir_offset:dir_offset + entries * ds._DIR_ENTRY.size])
+    data = buf[ds._align8(dir_offset + len(directory)):]
+    for i in range(entries):
+        fields = list(ds._DIR_ENTRY.unpack_from(directory, i * ds._DIR_ENTRY.size))
+        assert version > 1 or fields[-2] == ds._PLAIN  # no kind byte in version 1
+        fields[-1] = 0  # the capacity field was padding before version 6
+        ds._DIR_ENTRY.pack_into(directory, i * ds._DIR_ENTRY.size, *fields)
+    header["state"].pop("hash_family")  # older files hash with sha256
+    documents = header.get("documents")
+    if version < 4 and documents is not None:
+        assert not documents.pop("tombstones") and not documents.pop("keys")
+    if version == 1:
+        header["tables"] = {name: t["entries"] for name, t in header["tables"].items()}
+        for key in ("scalable", "hybrid", "blocked"):
+            header["state"].pop(key)
+    header_bytes = json.dumps(header).encode()
+    out = (ds._PREAMBLE.pack(ds.INDEX_MAGIC, version, flags, len(header_bytes))
+           + header_bytes + directory)
+    with open(path, "wb") as f:
+        f.write(out + bytes(ds._align8(len(out)) - len(out)) + data)
+
+
+def test_round_trip_preserves_results(tmp_path, backend):
+    system = PrivateDocumentSearch()
+    system.index.hybrid = True
+    system.compaction_threshold = 1.0
+    docs = make_docs(300)
+    system.add_documents(docs)
+    system.remove_document("d7")
+    system.update_document("d8", "covid vaccine")
+    expected = system.search_many(QUERIES)
+    path = str(tmp_path / "index.btix")
+    system.save(path)
+
+    loaded = PrivateDocumentSearch.load(path)
+    assert loaded.search_many(QUERIES) == expected
+    assert list(loaded.signatures.doc_ids) == list(system.signatures.doc_ids)
+    assert loaded.signatures.dead == system.signatures.dead
+    assert "d8" in loaded.search("covid AND vaccine")
+
+    # Saving over the file the index is mapped from must not fault its views
+    loaded.add_document("extra", "covid breach")
+    loaded.save(path)
+    assert "extra" in loaded.search("covid AND breach")
+    again = PrivateDocumentSearch.load(path)
+    assert again.search_many(QUERIES) == loaded.search_many(QUERIES)
+
+
+def test_round_trip_frozen_segment(tmp_path):
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(60))
+    assert system.freeze() > 0
+    expected = system.search_many(QUERIES)
+    path = str(tmp_path / "frozen.btix")
+    system.save(path)
+    loaded = PrivateDocumentSearch.load(path)
+    assert loaded.search_many(QUERIES) == expected
+    for term in system.term_frequencies:
+        assert_slots_alias(loaded.index, term)  # slots follow frozen filters
+
+
+@pytest.mark.parametrize("version", [1, 2, 3, 4, 5])
+def test_loads_older_versions(tmp_path, version):
+    system = PrivateDocumentSearch()
+    system.index.scalable = version > 1  # version 1 predates scalable filters
+    system.add_documents(make_docs(200))
+    expected = system.search_many(QUERIES)
+    path = str(tmp_path / f"v{version}.btix")
+    system.save(path)
+    downgrade(path, version)
+
+    loaded = PrivateDocumentSearch.load(path)
+    assert loaded.search_many(QUERIES) == expected
+    assert loaded.index.scalable == (version > 1)
+
+
+def test_file_format(tmp_path):
+    index = InvertedIndex()
+    index.index_document(Document("d1", None, {"covid"}))
+    path = str(tmp_path / "index.btix")
+    index.save(path)
+    with open(path, "rb") as f:
+        magic, version, _, _ = ds._PREAMBLE.unpack(f.read(ds._PREAMBLE.size))
+    assert (magic, version) == (ds.INDEX_MAGIC, ds.INDEX_VERSION)
+    assert ds._DIR_ENTRY.size == 64
+    assert InvertedIndex.load(path).search("covid").contains("d1")
+
+    with open(path, "r+b") as f:
+        f.write(ds._PREAMBLE.pack(ds.INDEX_MAGIC, 99, 0, 0))
+    with pytest.raises(ValueError, match="version"):
+        load_index(path)
+    with open(path, "r+b") as f:
+        f.write(b"NOPE")
+    with pytest.raises(ValueError, match="not a BTIX"):
+        load_index(path)
+
+
+def test_round_trip_shares_slot_filters(tmp_path):
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(300))
+    path = str(tmp_path / "index.btix")
+    system.save(path)
+    unaliased = PrivateDocumentSearch()
+    unaliased.index.update_frequencies({}, replace=True)
+    unaliased.add_documents(make_docs(300))
+    unaliased.save(str(tmp_path / "plain.btix"))
+    data = {p: (tmp_path / p).stat().st_size for p in ["index.btix", "plain.btix"]}
+    entries = len(system.index.keyword_to_docs) - len(unaliased.index.keyword_to_docs)
+    assert data["index.btix"] - data["plain.btix"] < 80 * entries  # directory only
+
+    loaded = PrivateDocumentSearch.load(path)
+    for term in system.term_frequencies:
+        assert_slots_alias(loaded.index, term)
+    loaded.add_document("extra", "backdoor")
+    assert all("extra" in loaded.search("backdoor") for _ in range(20))
+
+
+
+
+# ----------------------------------------------------------------------------
+# Deletion
+# ----------------------------------------------------------------------------
+
+def test_remove_update_compact(backend):
+    docs = dict(make_docs(400))
+    system = PrivateDocumentSearch()
+    system.compaction_threshold = 1.0  # compact by hand
+    system.add_documents(list(docs.items()))
+    removed = [f"d{i}" for i in range(0, 60, 2)]
+    updated = [f"d{i}" for i in range(1, 60, 2)]
+    for doc_id in removed:
+        assert system.remove_document(doc_id)
+        del docs[doc_id]
+    assert not system.remove_document(removed[0])
+    for doc_id in updated:
+        docs[doc_id] = "backdoor encryption"
+        system.update_document(doc_id, docs[doc_id])
+
+    def check():
+        for term in WORDS:
+            result = set(system.search(term))
+            assert result >= truth(docs.items(), term)
+            assert not result & set(removed)
+        # Updated documents match their new content, not the old
+        assert set(updated) <= set(system.search("backdoor AND encryption"))
+
+    check()
+    false_positives = sum(len(set(system.search(t)) - truth(docs.items(), t))
+                          for t in WORDS)
+    assert system.compact() > 0
+    assert not system.signatures.dead
+    assert len(system.signatures) == len(docs)
+    check()
+    # Exact refill: compaction never adds false positives
+    assert sum(len(set(system.search(t)) - truth(docs.items(), t))
+               for t in WORDS) <= false_positives
+
+
+def test_compaction_threshold_triggers():
+    system = PrivateDocumentSearch()
+    system.compaction_threshold = 0.1
+    system.add_documents(make_docs(50))
+    for i in range(6):
+        system.remove_document(f"d{i}")
+    assert len(system.signatures) < 50 and not system.signatures.dead
+
+
+def test_kept_documents_follow_removals():
+    system = PrivateDocumentSearch()
+    system.compaction_threshold = 1.0
+    system.add_documents(make_docs(5))
+    system.remove_document("d1")
+    system.update_document("d3", "backdoor")
+    system.add_document("d0", "covid")  # a second version under one ID
+    assert [doc.id for doc in system.documents] == ["d0", "d0", "d2", "d4", "d3"]
+    assert [doc.content for doc in system.documents][-1] == "backdoor"
+    system.update_document("d0", "leak")
+    assert [doc.id for doc in system.documents] == ["d2", "d4", "d3", "d0"]
+    assert system._live_documents() is not None  # exact refill stays possible
+
+
+# ----------------------------------------------------------------------------
+# Copy-on-write concurrency
+# ----------------------------------------------------------------------------
+
+def test_snapshot_isolation():
+    docs = make_docs(300)
+    search = ConcurrentSearch(max_delay=0)
+    try:
+        search._system.compaction_threshold = 0.05  # compact on the writer
+        search.ingest(iter(docs[:150]))
+        search.flush()
+        snapshot = search.snapshot()
+        before = snapshot.search_many(QUERIES)
+        generation = search.generation
+
+        search.ingest(iter(docs[150:]))
+        for i in range(20):
+            search.remove_document(f"d{i}")
+        search.update_document("d30", "backdoor")
+        search.flush()
+
+        assert search.generation > generation
+        assert len(snapshot.signatures) == 150
+        snapshot.cache = QueryCache()  # recompute rather than replay
+        assert snapshot.search_many(QUERIES) == before
+        current = search.snapshot()
+        assert "d3" not in current.search(docs[3][1].split()[0])
+        assert "d299" in current.search(docs[299][1].split()[0])
+        assert "d30" in current.search("backdoor")
+    finally:
+        search.close()
+
+
+def test_readers_during_ingest():
+    docs = make_docs(2000)
+    known = {doc_id for doc_id, _ in docs}
+    search = ConcurrentSearch(batch_size=100, max_delay=0)
+    errors = []
+    done = threading.Event()
+
+    def read():
+        seen = 0
+        try:
+            while not done.is_set():
+                snapshot = search.snapshot()
+                result = snapshot.search("covid")
+                assert set(result) <= known
+                assert len(snapshot.signatures) >= seen
+                seen = len(snapshot.signatures)
+        except Exception as exc:  # reported on the main thread
+            errors.append(exc)
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    try:
+        search.ingest(iter(docs))
+        search.flush()
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+        search.close()
+    assert not errors
+    assert set(search.search("covid")) >= truth(docs, "covid")
+
+
+def test_concurrent_search_rejects_sharded_systems():
+    with PrivateDocumentSearch(shards=2, shard_processes=False) as system:
+        with pytest.raises(ValueError):
+            ConcurrentSearch(system)
+
+
+
+# ----------------------------------------------------------------------------
+# Sharding
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_sharded_matches_collected(tmp_path, processes):
+    docs = make_docs(300)
+    with PrivateDocumentSearch(shards=3, shard_processes=processes) as system:
+        system.add_documents(docs)
+        expected = system.search_many(QUERIES)
+        for term in WORDS:
+            assert set(system.search(term)) >= truth(docs, term)
+
+        local = copy.copy(system)
+        local.index = system.index.collect()
+        local.cache = QueryCache()
+        assert local.search_many(QUERIES) == expected
+
+        assert system.index.add_shard() > 0
+        system.cache = QueryCache()
+        assert system.search_many(QUERIES) == expected
+
+        path = str(tmp_path / "sharded.btix")
+        system.save(path)
+        assert PrivateDocumentSearch.load(path).search_many(QUERIES) == expected
+
+
+# ----------------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------------
+
+def test_server_answers_pipelined_queries():
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(200))
+    expected = system.search_many(QUERIES)
+
+    async def run():
+        server = SearchServer(system, noise_rate=0)
+        host, port = await server.start()
+        try:
+            results = await search_remote(host, port, QUERIES)
+            with pytest.raises(ValueError):
+                await search_remote(host, port, ["covid vaccine"])
+            return results, server.stats()
+        finally:
+            await server.stop()
+
+    results, stats = asyncio.run(run())
+    assert results == expected
+    assert stats["requests"] == len(QUERIES)
+
+
+def test_server_reports_search_failures(monkeypatch):
+    system = PrivateDocumentSearch()
+    system.add_documents(make_docs(50))
+
+    def fail(queries):
+        raise RuntimeError("index unavailable")
+
+    async def run():
+        server = SearchServer(system, noise_rate=0)
+        host, port = await server.start()
+        try:
+            monkeypatch.setattr(system, "search_many", fail)
+            with pytest.raises(ValueError, match="index unavailable"):
+                await asyncio.wait_for(search_remote(host, port, ["covid"]), 5)
+            monkeypatch.undo()
+            return await asyncio.wait_for(search_remote(host, port, ["covid"]), 5)
+        finally:
+            await server.stop()
+
+    assert asyncio.run(run()) == system.search_many(["covid"])